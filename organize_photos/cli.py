@@ -1,19 +1,37 @@
 import logging
-from collections import defaultdict
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from itertools import batched, islice
 from pathlib import Path
 
 import click
 from tqdm import tqdm
 
 from .utils import (
+    DIRECTORY_SCHEMES,
+    HASH_ALGORITHMS,
+    HashStore,
     calculate_hash,
-    find_image_files,
+    find_duplicate_candidates,
+    find_image_paths,
     get_exif_date,
     get_files_to_delete,
+    get_hash_constructor,
     transfer_file,
     write_duplicate_report,
 )
 
+# Hashing workers must not be forked from a process that is already running
+# threads, so start them from a fork server (or spawn them, where fork servers
+# are unavailable).
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
 
 @click.group()
 def cli():
@@ -41,17 +59,57 @@ def cli():
     default=False,
     help="Copy files instead of moving them.",
 )
-def organize(source: tuple[Path, ...], destination: Path, copy: bool):
+@click.option(
+    "--hash",
+    "hash_algorithm",
+    type=click.Choice([*HASH_ALGORITHMS, "none"]),
+    default="blake3",
+    show_default=True,
+    help="The hash algorithm used to detect duplicates ('none' disables them).",
+)
+@click.option(
+    "--dedupe/--no-dedupe",
+    "detect_duplicates",
+    default=True,
+    show_default=True,
+    help="Hash files to detect duplicates and write duplicates.csv.",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(DIRECTORY_SCHEMES),
+    default="ym",
+    show_default=True,
+    help="Folder layout for dated photos: ym (YYYY-MM) or ymd (YYYY/MM/DD).",
+)
+def organize(
+    source: tuple[Path, ...],
+    destination: Path,
+    copy: bool,
+    hash_algorithm: str,
+    detect_duplicates: bool,
+    layout: str,
+):
     """Organize photos from source directories into a destination directory."""
+    algorithm: str | None = hash_algorithm
+    if not detect_duplicates or hash_algorithm == "none":
+        # Only sort by date: no hashing and no duplicate report
+        algorithm = None
+    else:
+        try:
+            get_hash_constructor(hash_algorithm)
+        except ImportError as e:
+            raise click.UsageError(str(e))
+
     destination.mkdir(exist_ok=True)
 
     # Validate paths
+    d_resolved = destination.resolve()
+    d_parents = frozenset(d_resolved.parents)
     for s in source:
         s_resolved = s.resolve()
-        d_resolved = destination.resolve()
         if (
             s_resolved == d_resolved
-            or s_resolved in d_resolved.parents
+            or s_resolved in d_parents
             or d_resolved in s_resolved.parents
         ):
             raise click.UsageError("Source and destination directories cannot overlap.")
@@ -65,37 +123,115 @@ def organize(source: tuple[Path, ...], destination: Path, copy: bool):
     )
 
     click.echo(f"Scanning {', '.join(str(s) for s in source)} for images...")
-    image_files = list(find_image_files(source))
+    # Paths stay plain strings until a file is transferred, which keeps the
+    # candidate set lookups and process pool pickling cheap
+    image_files = list(find_image_paths(source))
     if not image_files:
         click.echo("No image files found.")
         return
 
     click.echo(f"Found {len(image_files)} images. Processing...")
 
-    hashes = defaultdict(list)
-    with tqdm(total=len(image_files), desc="Organizing photos") as pbar:
-        for image_file in image_files:
+    if algorithm is None:
+        # Nothing is hashed, so there is no need for a hash store
+        _process_images(image_files, destination, copy, None, layout, None)
+    else:
+        with HashStore() as hashes:
+            _process_images(image_files, destination, copy, algorithm, layout, hashes)
+
+            # 4. Write duplicate report
+            write_duplicate_report(destination, hashes)
+
+    click.echo("Done!")
+
+
+def _process_images(
+    image_files: list[str],
+    destination: Path,
+    copy: bool,
+    hash_algorithm: str | None,
+    layout: str,
+    hashes: HashStore | None,
+):
+    """
+    Hash, date and transfer each image, recording the hashes in the store.
+
+    No files are hashed if hash_algorithm is None, and hashes may then be None.
+    """
+    # Only files that share their size and first bytes with another file can be
+    # duplicates, so only those are hashed in full
+    candidates = find_duplicate_candidates(image_files) if hash_algorithm else set()
+
+    # Target directories created so far and the names they hold, so each is
+    # only created and listed once
+    dir_cache: dict[Path, set[str]] = {}
+
+    # Hashing (CPU-bound) runs in worker processes and EXIF reads (I/O-bound) run
+    # in threads, so both overlap with the transfers. Hashes read files through
+    # memory maps, where a read error is a SIGBUS rather than an exception, so
+    # worker processes also keep such a crash from killing the whole run.
+    # Transfers stay on the main thread, in discovery order, so name conflicts
+    # are resolved deterministically and without races.
+    workers = os.cpu_count() or 1
+    max_in_flight = 2 * workers
+    with (
+        ExitStack() as stack,
+        ThreadPoolExecutor(max_workers=workers) as io_pool,
+        tqdm(total=len(image_files), desc="Organizing photos") as pbar,
+    ):
+        cpu_pool = ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT)
+        # The pool is replaced if a worker dies, so shut down the current one
+        stack.callback(lambda: cpu_pool.shutdown())
+
+        def submit_hash(image_file):
+            nonlocal cpu_pool
+            # Files are already hashed in parallel, so each hash is
+            # single-threaded
+            try:
+                return cpu_pool.submit(calculate_hash, image_file, hash_algorithm, 1)
+            except BrokenProcessPool:
+                cpu_pool.shutdown(wait=False, cancel_futures=True)
+                cpu_pool = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=_MP_CONTEXT
+                )
+                return cpu_pool.submit(calculate_hash, image_file, hash_algorithm, 1)
+
+        def submit(image_file):
+            hash_future = submit_hash(image_file) if image_file in candidates else None
+            return image_file, hash_future, io_pool.submit(get_exif_date, image_file)
+
+        # Keep a bounded window of files in flight so memory stays flat
+        remaining = iter(image_files)
+        pending = deque(map(submit, islice(remaining, max_in_flight)))
+        while pending:
+            image_file, hash_future, date_future = pending.popleft()
+            if (next_file := next(remaining, None)) is not None:
+                pending.append(submit(next_file))
+
             try:
-                # 1. Calculate hash
-                file_hash = calculate_hash(image_file)
+                # 1. Calculate hash (files that can't be duplicates are skipped)
+                try:
+                    file_hash = hash_future.result() if hash_future else None
+                except BrokenProcessPool:
+                    # A dead worker fails every hash in flight, so retry each
+                    # on a new pool; only a file that breaks it again is lost
+                    file_hash = submit_hash(image_file).result()
 
                 # 2. Get EXIF date
-                date = get_exif_date(image_file)
+                date = date_future.result()
 
                 # 3. Move or copy file
-                new_path = transfer_file(image_file, destination, date, copy)
-                hashes[file_hash].append((image_file, new_path))
+                new_path = transfer_file(
+                    image_file, destination, date, copy, dir_cache, layout
+                )
+                if file_hash is not None and hashes is not None:
+                    hashes.add(file_hash, image_file, new_path)
 
             except Exception as e:
                 logging.error(f"Error processing {image_file}: {e}")
             finally:
                 pbar.update(1)
 
-    # 4. Write duplicate report
-    write_duplicate_report(destination, hashes)
-
-    click.echo("Done!")
-
 
 @cli.command()
 @click.option(
@@ -123,19 +259,16 @@ def dedupe(report: Path, yes: bool):
     if not yes:
         click.confirm("Do you want to proceed with deleting these files?", abort=True)
 
+    # The progress bar is redrawn once per batch rather than once per file
     with tqdm(total=len(files_to_delete), desc="Deleting duplicates") as pbar:
-        for f in files_to_delete:
-            try:
-                if f.exists():
-                    f.unlink()
-                    pbar.set_postfix_str(f"Deleted {f}")
-                else:
-                    pbar.set_postfix_str(f"Skipped {f} (not found)")
-            except Exception as e:
-                logging.error(f"Error deleting {f}: {e}")
-                pbar.set_postfix_str(f"Error deleting {f}")
-            finally:
-                pbar.update(1)
+        for batch in batched(files_to_delete, 256):
+            for f in batch:
+                try:
+                    # Files that are already gone are skipped
+                    f.unlink(missing_ok=True)
+                except Exception as e:
+                    logging.error(f"Error deleting {f}: {e}")
+            pbar.update(len(batch))
 
     click.echo("Duplicate files deleted.")
 
@@ -1,134 +1,827 @@
 import csv
+import errno
 import hashlib
+import mmap
+import os
 import shutil
+import sqlite3
+import struct
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Literal
 
+import blake3
 from PIL import Image
 from datetime import datetime
 
 
+# Lowercase suffixes (without the dot) of the image files to organize
+_IMAGE_SUFFIXES = frozenset(("jpg", "jpeg"))
+
+
+def find_image_paths(source_dirs):
+    """
+    Recursively find all JPEG files in the source directories, as strings.
+
+    This is find_image_files without the Path wrapping, for callers that only
+    pass the paths on to functions taking any path-like value.
+    """
+    # os.scandir reuses the file type returned by readdir (d_type), avoiding the
+    # extra stat() and Path allocation per entry that Path.rglob incurs. Only
+    # DirEntry.is_dir/is_file are used, never DirEntry.stat(): they cost nothing
+    # unless the filesystem reports an unknown type (or the entry is a symlink to
+    # check), in which case DirEntry stats the entry once and caches the result.
+    for source_dir in source_dirs:
+        stack = [source_dir]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except PermissionError:
+                # Skip unreadable directories, as Path.rglob did
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    # A single split finds the suffix; as with Path.suffix, names
+                    # like ".jpg" have none
+                    stem, _, suffix = entry.name.rpartition(".")
+                    if stem and suffix.lower() in _IMAGE_SUFFIXES and entry.is_file():
+                        yield entry.path
+
+
 def find_image_files(source_dirs):
     """Recursively find all JPEG files in the source directories."""
-    extensions = {".jpg", ".jpeg"}
-    for source_dir in source_dirs:
-        for path in source_dir.rglob("*"):
-            if path.is_file() and path.suffix.lower() in extensions:
-                yield path
+    yield from map(Path, find_image_paths(source_dirs))
+
+
+# EXIF tags, see https://exiftool.org/TagNames/EXIF.html
+_EXIF_IFD_POINTER = 0x8769
+_DATE_TIME_ORIGINAL = 0x9003
+
+# The EXIF APP1 segment is normally near the start of the file, within this
+_EXIF_SCAN_SIZE = 65536
+
+
+def _find_ifd_entry(tiff, byte_order: str, ifd_offset: int, tag: int):
+    """Return the (type, count, value offset) of a tag in a TIFF IFD, if present."""
+    (num_entries,) = struct.unpack_from(byte_order + "H", tiff, ifd_offset)
+    for i in range(num_entries):
+        entry_offset = ifd_offset + 2 + 12 * i
+        entry_tag, entry_type, count = struct.unpack_from(
+            byte_order + "HHL", tiff, entry_offset
+        )
+        if entry_tag == tag:
+            return entry_type, count, entry_offset + 8
+    return None
+
+
+def _parse_exif_date(tiff) -> str | None:
+    """Find DateTimeOriginal in the TIFF structure of an EXIF payload."""
+    byte_order = {b"II": "<", b"MM": ">"}.get(bytes(tiff[:2]))
+    if byte_order is None:
+        raise ValueError("Invalid TIFF header")
+    magic, ifd0_offset = struct.unpack_from(byte_order + "HL", tiff, 2)
+    if magic != 42:
+        raise ValueError("Invalid TIFF header")
+
+    entry = _find_ifd_entry(tiff, byte_order, ifd0_offset, _DATE_TIME_ORIGINAL)
+    if entry is None:
+        pointer = _find_ifd_entry(tiff, byte_order, ifd0_offset, _EXIF_IFD_POINTER)
+        if pointer is None:
+            return None
+        (exif_ifd_offset,) = struct.unpack_from(byte_order + "L", tiff, pointer[2])
+        entry = _find_ifd_entry(tiff, byte_order, exif_ifd_offset, _DATE_TIME_ORIGINAL)
+        if entry is None:
+            return None
+
+    entry_type, count, value_offset = entry
+    if entry_type != 2:  # ASCII
+        raise ValueError("Unexpected DateTimeOriginal type")
+    if count > 4:
+        # Values that don't fit in the entry are stored elsewhere
+        (value_offset,) = struct.unpack_from(byte_order + "L", tiff, value_offset)
+    value = bytes(tiff[value_offset : value_offset + count])
+    if len(value) != count:
+        raise ValueError("Truncated DateTimeOriginal value")
+    return value.split(b"\0", 1)[0].decode("ascii")
+
+
+def _read_exif_date(image_path) -> str | None:
+    """
+    Read the DateTimeOriginal value straight from a JPEG's APP1 segment.
+
+    Only the start of the file is read, and the image is never decoded.
+
+    Args:
+        image_path: The path to the JPEG file.
+
+    Returns:
+        The raw date string, or None if the image has no EXIF date.
+
+    Raises:
+        ValueError, struct.error: If the file couldn't be parsed.
+    """
+    # Plain reads rather than a memory map: a read error then raises OSError
+    # for this file instead of a SIGBUS that would kill the whole run
+    with open(image_path, "rb") as f:
+        head = memoryview(f.read(_EXIF_SCAN_SIZE))
+
+        def read_at(offset: int, size: int):
+            # Segments are almost always within the first read
+            if offset + size <= len(head):
+                return head[offset : offset + size]
+            f.seek(offset)
+            return f.read(size)
+
+        if head[:2] != b"\xff\xd8":
+            raise ValueError("Not a JPEG file")
+
+        offset = 2
+        while True:
+            marker, length = struct.unpack(">HH", read_at(offset, 4))
+            if marker in (0xFFDA, 0xFFD9):
+                # Reached the image data (or the end) without finding EXIF data
+                return None
+            if marker >> 8 != 0xFF:
+                raise ValueError("Invalid JPEG marker")
+            if marker == 0xFFE1 and read_at(offset + 4, 6) == b"Exif\0\0":
+                segment = read_at(offset + 4, length - 2)
+                if len(segment) != length - 2:
+                    raise ValueError("Truncated EXIF segment")
+                return _parse_exif_date(segment[6:])
+            offset += 2 + length
+
+
+def _read_exif_date_with_pil(image_path) -> str | None:
+    """Read the DateTimeOriginal value using PIL."""
+    with Image.open(image_path) as img:
+        exif_data = img._getexif()
+        if exif_data:
+            # 36867 is the tag for DateTimeOriginal
+            return exif_data.get(36867)
+    return None
+
+
+def _parse_exif_datetime(date_str: str) -> datetime:
+    """Parse an EXIF "YYYY:MM:DD HH:MM:SS" date string."""
+    if (
+        len(date_str) == 19
+        and date_str[4] == date_str[7] == date_str[13] == date_str[16] == ":"
+        and date_str[10] == " "
+        # int() also accepts signs, spaces, underscores and non-ASCII digits,
+        # which strptime rejects
+        and date_str.isascii()
+        and (
+            date_str[0:4]
+            + date_str[5:7]
+            + date_str[8:10]
+            + date_str[11:13]
+            + date_str[14:16]
+            + date_str[17:19]
+        ).isdigit()
+    ):
+        # Slicing the fixed-width fields is much faster than strptime
+        try:
+            return datetime(
+                int(date_str[0:4]),
+                int(date_str[5:7]),
+                int(date_str[8:10]),
+                int(date_str[11:13]),
+                int(date_str[14:16]),
+                int(date_str[17:19]),
+            )
+        except ValueError:
+            pass
+    # Let strptime accept (or reject) anything that isn't in the usual layout
+    return datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
 
 
 def get_exif_date(image_path):
     """Extract the original creation date from the image's EXIF data."""
     try:
-        with Image.open(image_path) as img:
-            exif_data = img._getexif()
-            if exif_data:
-                # 36867 is the tag for DateTimeOriginal
-                date_str = exif_data.get(36867)
-                if date_str:
-                    return datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
+        try:
+            date_str = _read_exif_date(image_path)
+        except (ValueError, struct.error):
+            # Let PIL handle anything the fast parser doesn't understand
+            date_str = _read_exif_date_with_pil(image_path)
+        if date_str:
+            return _parse_exif_datetime(date_str)
     except Exception:
         # Could be a file read error, or the file may not have EXIF data
         pass
     return None
 
 
-def create_date_based_directory(destination_dir: Path, date: datetime) -> Path:
-    """Create a date-based directory (YYYY-MM) if it doesn't exist."""
-    month_dir = destination_dir / f"{date.year}-{date.month:02d}"
-    month_dir.mkdir(parents=True, exist_ok=True)
-    return month_dir
+def _ensure_directory(directory: Path, dir_cache: dict[Path, set[str]] | None = None):
+    """
+    Create a directory if needed.
+
+    When a dir_cache is given, each directory is only created (and listed) the
+    first time it is seen; the cache maps it to the names of the files it holds.
+    """
+    if dir_cache is None:
+        directory.mkdir(parents=True, exist_ok=True)
+    elif directory not in dir_cache:
+        directory.mkdir(parents=True, exist_ok=True)
+        with os.scandir(directory) as entries:
+            dir_cache[directory] = {entry.name for entry in entries}
+
+
+DIRECTORY_SCHEMES = ("ym", "ymd")
+
+
+def create_date_based_directory(
+    destination_dir: Path,
+    date: datetime,
+    dir_cache: dict[Path, set[str]] | None = None,
+    scheme: Literal["ym", "ymd"] = "ym",
+) -> Path:
+    """
+    Create a date-based directory (YYYY-MM, or YYYY/MM/DD) if it doesn't exist.
+
+    Args:
+        destination_dir: The root destination directory.
+        date: The date used to name the directory.
+        dir_cache: Optional mapping of the directories already created during
+            this run to the file names they contain. Directories in it are not
+            created again, and new ones are added.
+        scheme: "ym" for a YYYY-MM directory, or "ymd" for YYYY/MM/DD.
+
+    Returns:
+        The path of the date-based directory.
+    """
+    if scheme == "ymd":
+        date_dir = (
+            destination_dir / f"{date.year}" / f"{date.month:02d}" / f"{date.day:02d}"
+        )
+    else:
+        date_dir = destination_dir / f"{date.year}-{date.month:02d}"
+    _ensure_directory(date_dir, dir_cache)
+    return date_dir
+
+
+def _resolve_unique_name(name: str, is_taken) -> str:
+    """Return name if it's free, or else a free numbered variant (name-1, ...)."""
+    if not is_taken(name):
+        return name
+
+    stem, dot, suffix = name.rpartition(".")
+    if not stem:
+        stem, dot, suffix = name, "", ""
+
+    def numbered(counter: int) -> str:
+        return f"{stem}-{counter}{dot}{suffix}"
+
+    # Numbered names are normally taken contiguously, so probe -1, -2, -4, ...
+    # until one is free, then binary search between the last taken and first
+    # free probe: O(log n) checks rather than O(n). The result is always free,
+    # though not necessarily the lowest free number.
+    taken, free = 0, 1
+    while is_taken(numbered(free)):
+        taken, free = free, free * 2
+    while free - taken > 1:
+        middle = (taken + free) // 2
+        if is_taken(numbered(middle)):
+            taken = middle
+        else:
+            free = middle
+    return numbered(free)
+
 
+def get_unique_filenames_in(
+    directory: Path, names, existing_names: set[str] | None = None
+) -> list[Path]:
+    """
+    Generate unique filenames for several files placed in the same directory.
+
+    The directory is listed once and conflicts are resolved in memory, so only
+    the chosen name is checked on disk. Names are reserved in order, so
+    repeated names get distinct numbered variants.
+
+    Args:
+        directory: The destination directory.
+        names: The desired file names.
+        existing_names: Optional set of the file names already in the
+            directory, used instead of listing it. The chosen names are added
+            to it.
+
+    Returns:
+        A destination path for each name, in the same order.
+    """
+    if existing_names is None:
+        try:
+            with os.scandir(directory) as entries:
+                existing_names = {entry.name for entry in entries}
+        except FileNotFoundError:
+            existing_names = set()
+
+    def is_taken(name: str) -> bool:
+        return name in existing_names or (directory / name).exists()
+
+    paths = []
+    for name in names:
+        unique_name = _resolve_unique_name(name, existing_names.__contains__)
+        if (directory / unique_name).exists():
+            # The listing doesn't know about it, e.g. on a case-insensitive
+            # filesystem or if someone else created it, so check the disk too
+            unique_name = _resolve_unique_name(name, is_taken)
+        existing_names.add(unique_name)
+        paths.append(directory / unique_name)
+    return paths
 
-def get_unique_filename(destination_path: Path) -> Path:
-    """Generate a unique filename if the destination path already exists."""
-    if not destination_path.exists():
-        return destination_path
 
+def get_unique_filename(
+    destination_path: Path, existing_names: set[str] | None = None
+) -> Path:
+    """
+    Generate a unique filename if the destination path already exists.
+
+    Args:
+        destination_path: The desired destination path.
+        existing_names: Optional set of the file names already in the
+            destination directory. Conflicts are resolved against it (and the
+            filesystem), and the chosen name is added to it.
+
+    Returns:
+        A destination path that doesn't exist yet.
+    """
     parent = destination_path.parent
-    stem = destination_path.stem
-    suffix = destination_path.suffix
 
-    counter = 1
-    while True:
-        new_stem = f"{stem}-{counter}"
-        new_path = parent / (new_stem + suffix)
-        if not new_path.exists():
-            return new_path
-        counter += 1
+    def is_taken(name: str) -> bool:
+        if existing_names is not None and name in existing_names:
+            return True
+        # Always checked on disk too: the filesystem may match names the set
+        # doesn't (e.g. case-insensitively), or someone else may have created it
+        return (parent / name).exists()
+
+    new_name = _resolve_unique_name(destination_path.name, is_taken)
+    if existing_names is not None:
+        existing_names.add(new_name)
+    return parent / new_name
+
+
+def _copy_file(source: str | Path, destination: Path):
+    """Copy a file and its metadata, letting the kernel copy the data if possible."""
+    if not hasattr(os, "copy_file_range"):
+        # shutil.copy2 already uses the fastest copy available on this platform
+        shutil.copy2(source, destination)
+        return
+
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            size = os.fstat(src.fileno()).st_size
+            copied = 0
+            # copy_file_range copies in the kernel, and reflinks on XFS/Btrfs
+            while written := os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                copied += written
+        # Some filesystems (e.g. FUSE, ecryptfs) report 0 without copying
+        # anything, so a short copy must not be taken for the whole file
+        complete = copied >= size
+    except OSError:
+        complete = False
+    if not complete:
+        # Not supported between these files; shutil.copyfile still avoids a
+        # userspace copy by using sendfile
+        shutil.copyfile(source, destination)
+    shutil.copystat(source, destination)
+
+
+def _move_file(source: str | Path, destination: Path):
+    """Move a file, renaming it in place when possible."""
+    try:
+        # A plain rename skips the extra checks shutil.move does per file
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # The paths are on different filesystems, so copy and remove instead
+        _copy_file(source, destination)
+        os.unlink(source)
 
 
 def transfer_file(
-    image_path: Path, destination_dir: Path, date: datetime | None, copy: bool
+    image_path: str | Path,
+    destination_dir: Path,
+    date: datetime | None,
+    copy: bool,
+    dir_cache: dict[Path, set[str]] | None = None,
+    scheme: Literal["ym", "ymd"] = "ym",
 ) -> Path:
     """Move or copy an image to the appropriate directory."""
     if date:
-        target_dir = create_date_based_directory(destination_dir, date)
+        target_dir = create_date_based_directory(
+            destination_dir, date, dir_cache, scheme
+        )
     else:
         target_dir = destination_dir / "missing_date"
-        target_dir.mkdir(exist_ok=True)
+        _ensure_directory(target_dir, dir_cache)
 
-    destination_path = get_unique_filename(target_dir / image_path.name)
+    existing_names = dir_cache[target_dir] if dir_cache is not None else None
+    destination_path = get_unique_filename(
+        target_dir / os.path.basename(image_path), existing_names
+    )
 
     if copy:
-        shutil.copy2(str(image_path), str(destination_path))
+        _copy_file(image_path, destination_path)
     else:
-        shutil.move(str(image_path), str(destination_path))
+        _move_file(image_path, destination_path)
     return destination_path
 
 
-def calculate_hash(image_path: Path) -> str:
-    """Calculate the SHA256 hash of a file."""
-    sha256 = hashlib.sha256()
-    with open(image_path, "rb") as f:
-        while chunk := f.read(8192):
-            sha256.update(chunk)
-    return sha256.hexdigest()
+HASH_ALGORITHMS = ("blake3", "sha256", "xxh3")
 
 
-def write_duplicate_report(
-    destination_dir: Path, duplicates: defaultdict[str, list[tuple[Path, Path]]]
-):
-    """Write a report of duplicate files to duplicates.csv."""
-    report_path = destination_dir / "duplicates.csv"
-    with open(report_path, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["hash", "new_filepath", "old_filepath"])
-        for hash_val, file_list in duplicates.items():
-            if len(file_list) > 1:
-                for old_path, new_path in file_list:
-                    writer.writerow([hash_val, str(new_path), str(old_path)])
+def get_hash_constructor(algorithm: str):
+    """Return a callable that creates a new hash object for the given algorithm."""
+    if algorithm == "blake3":
+        return blake3.blake3
+    if algorithm == "sha256":
+        return hashlib.sha256
+    if algorithm == "xxh3":
+        try:
+            import xxhash
+        except ImportError as e:
+            raise ImportError("The xxh3 hash requires the 'xxhash' package.") from e
+        return xxhash.xxh3_128
+    raise ValueError(f"Unknown hash algorithm: {algorithm}")
 
 
+# Files are hashed in 1 MiB chunks, read into a buffer reused by each thread
+_HASH_BUFFER_SIZE = 1 << 20
+_hash_buffers = threading.local()
 
-def get_files_to_delete(report_path: Path) -> list[Path]:
+
+def _get_hash_buffer() -> memoryview:
+    """Return this thread's reusable read buffer for hashing."""
+    buffer = getattr(_hash_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _hash_buffers.buffer = memoryview(bytearray(_HASH_BUFFER_SIZE))
+    return buffer
+
+
+# With tree hashing, files larger than this are split into fixed-size slabs
+# that are hashed in parallel, and the slab digests are hashed again
+_TREE_HASH_THRESHOLD = 64 << 20
+_TREE_SLAB_SIZE = 4 << 20
+
+
+def _calculate_tree_hash(f, size: int, new_hasher, max_threads: int | None) -> str:
+    """Hash an open file as the hash of its concatenated slab digests."""
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+
+        def slab_digest(offset: int) -> bytes:
+            # hashlib releases the GIL while hashing, so slabs hash in parallel
+            return new_hasher(view[offset : offset + _TREE_SLAB_SIZE]).digest()
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_threads or os.cpu_count()) as pool:
+                digests = list(pool.map(slab_digest, range(0, size, _TREE_SLAB_SIZE)))
+        finally:
+            view.release()
+    return new_hasher(b"".join(digests)).hexdigest()
+
+
+def calculate_hash(
+    image_path: str | Path,
+    algorithm: str = "blake3",
+    max_threads: int | None = None,
+    tree: bool = False,
+) -> str:
     """
-    Reads a duplicate report and returns a list of files to be deleted.
+    Calculate the hash of a file.
 
     Args:
-        report_path: The path to the duplicates.csv file.
+        image_path: The path to the file.
+        algorithm: One of HASH_ALGORITHMS; BLAKE3 by default.
+        max_threads: The maximum number of threads used to hash the file, or
+            None to decide automatically. Only used by BLAKE3 and tree hashing.
+            Callers that already hash many files in parallel should pass 1 to
+            avoid oversubscription.
+        tree: SHA-256 and xxh3 only. Hash files larger than 64 MiB as 4 MiB
+            slabs in parallel, returning the hash of the slab digests. This is
+            not the plain digest of the file, so it must be used consistently
+            when comparing hashes. BLAKE3 is a tree hash already.
 
     Returns:
-        A list of paths for files that should be deleted.
+        The hex digest of the file's content.
+    """
+    if algorithm == "blake3":
+        # BLAKE3 hashes the memory-mapped file directly with SIMD, avoiding
+        # read copies, and can split a large file across threads
+        hasher = blake3.blake3(
+            max_threads=blake3.blake3.AUTO if max_threads is None else max_threads
+        )
+        hasher.update_mmap(image_path)
+        return hasher.hexdigest()
+
+    new_hasher = get_hash_constructor(algorithm)
+    hasher = new_hasher()
+    with open(image_path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if tree and size > _TREE_HASH_THRESHOLD:
+            return _calculate_tree_hash(f, size, new_hasher, max_threads)
+
+        if size > _HASH_BUFFER_SIZE:
+            # Hash large files straight from the page cache: no read copies,
+            # and a single update that releases the GIL for the whole file.
+            # hashlib's SHA-256 is OpenSSL's, which already uses the CPU's SHA
+            # extensions, so there is no interpreter overhead left to remove.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                hasher.update(mm)
+            return hasher.hexdigest()
+
+        # A small file fits in one read into this thread's reused buffer, which
+        # is cheaper than setting up a mapping
+        buffer = _get_hash_buffer()
+        while size := f.readinto(buffer):
+            hasher.update(buffer[:size])
+    return hasher.hexdigest()
+
+
+def calculate_hashes(
+    image_paths,
+    algorithm: str = "blake3",
+    workers: int | None = None,
+    errors: dict[str | Path, OSError] | None = None,
+) -> dict[str | Path, str]:
+    """
+    Calculate the hashes of many files concurrently.
+
+    The hash functions release the GIL while hashing, so a thread pool keeps
+    several files streaming at once. The largest files are started first so
+    that a big file doesn't finish last on its own.
+
+    Args:
+        image_paths: The paths of the files to hash.
+        algorithm: One of HASH_ALGORITHMS; BLAKE3 by default.
+        workers: The number of threads to use; defaults to the CPU count.
+        errors: Optional mapping that receives the path and error of each file
+            that couldn't be read. Such files are then left out of the result
+            instead of the error being raised.
+
+    Returns:
+        A mapping of each path to the hex digest of its content.
+
+    Raises:
+        OSError: If a file couldn't be read and no errors mapping was given.
+    """
+
+    def size(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            # Let calculate_hash surface the error
+            return 0
+
+    def hash_file(path):
+        try:
+            # Files are hashed in parallel, so each hash is single-threaded
+            return calculate_hash(path, algorithm, 1)
+        except OSError as e:
+            if errors is None:
+                raise
+            errors[path] = e
+            return None
+
+    paths = sorted(image_paths, key=size, reverse=True)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        hashes = pool.map(hash_file, paths)
+        return {path: file_hash for path, file_hash in zip(paths, hashes) if file_hash}
+
+
+# Files of the same size are compared by a hash of their first bytes before
+# being hashed in full
+_PREFIX_SIZE = 4096
+
+
+def _hash_prefix(path) -> bytes:
+    """Hash the first few KiB of a file."""
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(_PREFIX_SIZE)).digest()
+
+
+def find_duplicate_candidates(image_paths) -> set[str | Path]:
+    """
+    Find the files that may have a duplicate, without reading them in full.
+
+    A file cannot have a duplicate if its size is unique, or if its first 4 KiB
+    differ from those of every other file of the same size, so only the files
+    returned here need to be hashed in full.
+
+    Args:
+        image_paths: The paths of the files to check.
+
+    Returns:
+        The set of paths that may have a duplicate.
+    """
+    candidates = set()
+
+    by_size = defaultdict(list)
+    for path in image_paths:
+        try:
+            by_size[os.stat(path).st_size].append(path)
+        except OSError:
+            # Keep it as a candidate, so the hashing step reports the error
+            candidates.add(path)
+
+    by_prefix = defaultdict(list)
+    for size, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+        for path in paths:
+            try:
+                by_prefix[size, _hash_prefix(path)].append(path)
+            except OSError:
+                candidates.add(path)
+
+    for paths in by_prefix.values():
+        if len(paths) > 1:
+            candidates.update(paths)
+    return candidates
+
+
+def find_duplicates(
+    image_paths,
+    algorithm: str = "blake3",
+    errors: dict[str | Path, OSError] | None = None,
+) -> dict[str, list[str | Path]]:
+    """
+    Find groups of identical files.
+
+    Only the files returned by find_duplicate_candidates are hashed in full.
+    Files that can't be read are skipped, so they don't hide the duplicates
+    among the other files.
+
+    Args:
+        image_paths: The paths of the files to check.
+        algorithm: The hash algorithm used to compare files.
+        errors: Optional mapping that receives the path and error of each file
+            that couldn't be read.
+
+    Returns:
+        A mapping of each shared hash to the paths of the files with that hash.
+    """
+    image_paths = list(image_paths)
+    candidates = find_duplicate_candidates(image_paths)
+
+    hashes = calculate_hashes(
+        [path for path in image_paths if path in candidates],
+        algorithm,
+        errors={} if errors is None else errors,
+    )
+
+    by_hash = defaultdict(list)
+    for path, file_hash in hashes.items():
+        by_hash[file_hash].append(path)
+    return {file_hash: paths for file_hash, paths in by_hash.items() if len(paths) > 1}
+
+
+_DUPLICATES_QUERY = """
+SELECT hash, new_path, old_path FROM hashes
+WHERE hash IN (SELECT hash FROM hashes GROUP BY hash HAVING COUNT(*) > 1)
+ORDER BY hash, rowid
+"""
+
+
+class HashStore:
+    """
+    Stores the hash and old/new paths of every processed file.
+
+    Rows are kept in a temporary SQLite database instead of in memory, so memory
+    use stays bounded however many files are processed. Rows are inserted in
+    batches.
     """
+
+    def __init__(self, database: str = "", batch_size: int = 1000):
+        # An empty database name creates a private temporary on-disk database
+        self._connection = sqlite3.connect(database)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (hash TEXT, new_path TEXT, old_path TEXT)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS hashes_by_hash ON hashes (hash)"
+        )
+        self._batch_size = batch_size
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, file_hash: str, old_path: str | Path, new_path: str | Path):
+        """Record a processed file."""
+        self._pending.append((file_hash, str(new_path), str(old_path)))
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert any buffered rows into the database."""
+        if self._pending:
+            self._connection.executemany(
+                "INSERT INTO hashes VALUES (?, ?, ?)", self._pending
+            )
+            self._connection.commit()
+            self._pending.clear()
+
+    def duplicates(self):
+        """Yield (hash, new_path, old_path) for every file sharing its hash."""
+        self.flush()
+        yield from self._connection.execute(_DUPLICATES_QUERY)
+
+    def close(self):
+        """Close the database, discarding it if it's temporary."""
+        self._connection.close()
+
+
+def write_duplicate_report(destination_dir: Path, hashes: HashStore):
+    """Write a report of duplicate files to duplicates.csv."""
+    report_path = destination_dir / "duplicates.csv"
+    with open(report_path, "w", newline="", buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(["hash", "new_filepath", "old_filepath"])
+        # The rows are already (hash, new path, old path) tuples, so they can be
+        # streamed from the database straight into the C writer
+        writer.writerows(hashes.duplicates())
+
+
+def _read_duplicate_groups(report_path: Path) -> list[list[str]]:
+    """Group the files in a duplicate report by hash, keeping shared hashes."""
     try:
-        with open(report_path, "r", newline="") as f:
+        with open(report_path, "r", newline="", buffering=1 << 20) as f:
             reader = csv.reader(f)
             next(reader)  # Skip header row
             duplicates = defaultdict(list)
             for row in reader:
                 if len(row) >= 2:
                     file_hash, new_filepath = row[0], row[1]
-                    duplicates[file_hash].append(Path(new_filepath))
+                    duplicates[file_hash].append(new_filepath)
     except (FileNotFoundError, StopIteration):
         return []
 
+    return [file_list for file_list in duplicates.values() if len(file_list) > 1]
+
+
+def _read_duplicate_groups_with_pyarrow(report_path: Path) -> list[list[str]]:
+    """
+    Group the files in a duplicate report by hash using pyarrow.
+
+    pyarrow parses the CSV with a multithreaded C++ reader and groups it
+    vectorized, which is much faster than csv.reader for very large reports.
+
+    Raises:
+        ImportError: If pyarrow isn't installed.
+        OSError, ValueError: If pyarrow can't read the report.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pa_csv
+
+    # Skip the header row and read the hash and new path columns as strings
+    table = pa_csv.read_csv(
+        report_path,
+        read_options=pa_csv.ReadOptions(skip_rows=1, autogenerate_column_names=True),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=["f0", "f1"],
+            column_types={"f0": pa.string(), "f1": pa.string()},
+        ),
+    )
+    groups = table.group_by("f0").aggregate([("f1", "list")])
+    groups = groups.filter(pc.greater(pc.list_value_length(groups["f1_list"]), 1))
+    return groups["f1_list"].to_pylist()
+
+
+def get_files_to_delete(report_path: Path) -> list[Path]:
+    """
+    Reads a duplicate report and returns a list of files to be deleted.
+
+    Args:
+        report_path: The path to the duplicates.csv file.
+
+    Returns:
+        A list of paths for files that should be deleted.
+    """
+    try:
+        duplicate_groups = _read_duplicate_groups_with_pyarrow(report_path)
+    except (ImportError, OSError, ValueError):
+        # pyarrow is optional, and rejects some reports (e.g. empty ones)
+        duplicate_groups = _read_duplicate_groups(report_path)
+
     files_to_delete = []
-    for _, file_list in duplicates.items():
-        if len(file_list) > 1:
-            # Sort by path to ensure consistent "first" file
-            sorted_files = sorted(file_list, key=lambda p: str(p))
-            # Add all but the first file to the deletion list
-            files_to_delete.extend(sorted_files[1:])
-
-    return files_to_delete
+    for file_list in duplicate_groups:
+        # The lowest path is kept, so the choice is consistent. Finding it is a
+        # single linear pass; sorting the whole group isn't needed for that.
+        kept_file = min(file_list)
+        files_to_delete.extend(f for f in file_list if f != kept_file)
+
+    # Paths are kept as plain strings until here, so only the files that are
+    # actually deleted get a Path
+    return [Path(f) for f in files_to_delete]
@@ -1,7 +1,11 @@
 import pytest
 import csv
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
 from click.testing import CliRunner
 
+import organize_photos.cli
 from organize_photos.cli import cli
 
 
@@ -182,3 +186,149 @@ def test_dedupe_handles_report_with_no_duplicates(runner, tmp_path):
 
     assert result.exit_code == 0
     assert "No duplicate files found to delete" in result.output
+
+
+def test_organize_reports_duplicates(runner, tmp_path):
+    """Test that organize hashes files and reports identical ones as duplicates."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    dest_dir = tmp_path / "destination"
+    dest_dir.mkdir()
+
+    (source_dir / "a.jpg").write_bytes(b"same content")
+    (source_dir / "b.jpg").write_bytes(b"same content")
+    (source_dir / "c.jpg").write_bytes(b"other content")
+
+    result = runner.invoke(
+        cli,
+        ["organize", "--source", str(source_dir), "--destination", str(dest_dir)],
+    )
+    assert result.exit_code == 0
+
+    with open(dest_dir / "duplicates.csv", "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader)  # Skip header row
+        old_paths = {row[2] for row in reader}
+
+    assert old_paths == {str(source_dir / "a.jpg"), str(source_dir / "b.jpg")}
+
+
+def test_dedupe_skips_missing_files(runner, tmp_path):
+    """Test that the dedupe command skips files that no longer exist."""
+    report_path = tmp_path / "duplicates.csv"
+    file1 = tmp_path / "a.jpg"
+    file2 = tmp_path / "b.jpg"
+    file1.touch()
+
+    with open(report_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["hash", "new_filepath", "old_filepath"])
+        writer.writerow(["hash1", str(file1), "old/a.jpg"])
+        writer.writerow(["hash1", str(file2), "old/b.jpg"])
+
+    result = runner.invoke(cli, ["dedupe", "--report", str(report_path), "--yes"])
+
+    assert result.exit_code == 0
+    assert "Duplicate files deleted" in result.output
+    assert file1.exists()
+
+
+@pytest.mark.parametrize("option", ["--no-dedupe", "--hash=none"])
+def test_organize_without_dedupe_skips_report(runner, tmp_path, option):
+    """Test that organize skips hashing and the report when dedupe is disabled."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    dest_dir = tmp_path / "destination"
+    dest_dir.mkdir()
+
+    (source_dir / "a.jpg").write_bytes(b"same content")
+    (source_dir / "b.jpg").write_bytes(b"same content")
+
+    result = runner.invoke(
+        cli,
+        [
+            "organize",
+            "--source",
+            str(source_dir),
+            "--destination",
+            str(dest_dir),
+            option,
+        ],
+    )
+    assert result.exit_code == 0
+    assert (dest_dir / "missing_date" / "a.jpg").is_file()
+    assert (dest_dir / "missing_date" / "b.jpg").is_file()
+    assert not (dest_dir / "duplicates.csv").exists()
+
+
+def test_organize_creates_each_directory_once(runner, tmp_path, monkeypatch):
+    """Test that organize doesn't recreate a target directory for every file."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    dest_dir = tmp_path / "destination"
+    dest_dir.mkdir()
+
+    for i in range(10):
+        (source_dir / f"image{i}.jpg").write_bytes(b"x" * i)
+
+    created = []
+    original_mkdir = Path.mkdir
+
+    def spy_mkdir(self, *args, **kwargs):
+        created.append(self)
+        original_mkdir(self, *args, **kwargs)
+
+    monkeypatch.setattr(Path, "mkdir", spy_mkdir)
+
+    result = runner.invoke(
+        cli,
+        ["organize", "--source", str(source_dir), "--destination", str(dest_dir)],
+    )
+    assert result.exit_code == 0
+    assert len(list((dest_dir / "missing_date").iterdir())) == 10
+    assert created.count(dest_dir / "missing_date") == 1
+
+
+def test_organize_recovers_from_a_dead_hash_worker(runner, tmp_path, monkeypatch):
+    """Test that files in flight when a hashing worker dies are still processed."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    dest_dir = tmp_path / "destination"
+    dest_dir.mkdir()
+
+    (source_dir / "a.jpg").write_bytes(b"same content")
+    (source_dir / "b.jpg").write_bytes(b"same content")
+
+    pools = []
+
+    class Pool(ThreadPoolExecutor):
+        """Runs hashes in threads; the first pool behaves as if a worker died."""
+
+        def __init__(self, max_workers=None, mp_context=None):
+            super().__init__(max_workers)
+            pools.append(self)
+            self.broken = len(pools) == 1
+            self.submitted = 0
+
+        def submit(self, *args, **kwargs):
+            if not self.broken:
+                return super().submit(*args, **kwargs)
+            self.submitted += 1
+            if self.submitted > 1:
+                raise BrokenProcessPool("A process in the pool was terminated")
+            future = Future()
+            future.set_exception(BrokenProcessPool("A process in the pool died"))
+            return future
+
+    monkeypatch.setattr(organize_photos.cli, "ProcessPoolExecutor", Pool)
+
+    result = runner.invoke(
+        cli,
+        ["organize", "--source", str(source_dir), "--destination", str(dest_dir)],
+    )
+    assert result.exit_code == 0
+    assert len(pools) == 2
+    assert (dest_dir / "missing_date" / "a.jpg").is_file()
+    assert (dest_dir / "missing_date" / "b.jpg").is_file()
+    with open(dest_dir / "duplicates.csv", newline="") as f:
+        assert len(list(csv.reader(f))) == 3
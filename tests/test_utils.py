@@ -1,24 +1,85 @@
 import pytest
+import base64
 import csv
+import errno
 import hashlib
-from collections import defaultdict
+import os
+import struct
+import sys
 from datetime import datetime
-import piexif
-
-
-from PIL import Image
+from pathlib import Path
+import blake3
 
+import organize_photos.utils
 from organize_photos.utils import (
+    HashStore,
     calculate_hash,
+    calculate_hashes,
     create_date_based_directory,
+    find_duplicate_candidates,
+    find_duplicates,
     find_image_files,
+    find_image_paths,
     get_exif_date,
     get_unique_filename,
+    get_unique_filenames_in,
     transfer_file,
     write_duplicate_report,
     get_files_to_delete,
+    _parse_exif_datetime,
+)
+
+# Tiny JPEGs encoded once with PIL, the EXIF one with a piexif.dump() payload,
+# so the tests don't encode images on every run
+
+# An 8x8 red JPEG with a DateTimeOriginal of 2023:01:01 12:30:00
+_EXIF_JPEG_B64 = (
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/4QBERXhpZgAATU0AKgAAAAgAAYdpAAQAAAABAAAAGgAA"
+    "AAAAAZADAAIAAAAUAAAAKDIwMjM6MDE6MDEgMTI6MzA6MDAA/9sAQwAIBgYHBgUIBwcHCQkI"
+    "CgwUDQwLCwwZEhMPFB0aHx4dGhwcICQuJyAiLCMcHCg3KSwwMTQ0NB8nOT04MjwuMzQy/9sA"
+    "QwEJCQkMCwwYDQ0YMiEcITIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIy"
+    "MjIyMjIyMjIyMjIy/8AAEQgACAAIAwEiAAIRAQMRAf/EAB8AAAEFAQEBAQEBAAAAAAAAAAAB"
+    "AgMEBQYHCAkKC//EALUQAAIBAwMCBAMFBQQEAAABfQECAwAEEQUSITFBBhNRYQcicRQygZGh"
+    "CCNCscEVUtHwJDNicoIJChYXGBkaJSYnKCkqNDU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVm"
+    "Z2hpanN0dXZ3eHl6g4SFhoeIiYqSk5SVlpeYmZqio6Slpqeoqaqys7S1tre4ubrCw8TFxsfI"
+    "ycrS09TV1tfY2drh4uPk5ebn6Onq8fLz9PX29/j5+v/EAB8BAAMBAQEBAQEBAQEAAAAAAAAB"
+    "AgMEBQYHCAkKC//EALURAAIBAgQEAwQHBQQEAAECdwABAgMRBAUhMQYSQVEHYXETIjKBCBRC"
+    "kaGxwQkjM1LwFWJy0QoWJDThJfEXGBkaJicoKSo1Njc4OTpDREVGR0hJSlNUVVZXWFlaY2Rl"
+    "ZmdoaWpzdHV2d3h5eoKDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXG"
+    "x8jJytLT1NXW19jZ2uLj5OXm5+jp6vLz9PX29/j5+v/aAAwDAQACEQMRAD8A4uiiivmT9xP/"
+    "2Q=="
 )
 
+# An 8x8 blue JPEG without EXIF data
+_NOEXIF_JPEG_B64 = (
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAgGBgcGBQgHBwcJCQgKDBQNDAsLDBkSEw8UHRof"
+    "Hh0aHBwgJC4nICIsIxwcKDcpLDAxNDQ0Hyc5PTgyPC4zNDL/2wBDAQkJCQwLDBgNDRgyIRwh"
+    "MjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjL/wAAR"
+    "CAAIAAgDASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAA"
+    "AgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkK"
+    "FhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWG"
+    "h4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl"
+    "5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREA"
+    "AgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYk"
+    "NOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOE"
+    "hYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk"
+    "5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwDxyiiiv3E8w//Z"
+)
+
+
+def _jpeg_with_exif(exif: bytes) -> bytes:
+    """Return the EXIF-less test JPEG with an APP1 segment holding exif."""
+    jpeg = base64.b64decode(_NOEXIF_JPEG_B64)
+    segment = b"Exif\x00\x00" + exif
+    # The APP1 segment goes right after the SOI marker
+    return (
+        jpeg[:2]
+        + b"\xff\xe1"
+        + struct.pack(">H", len(segment) + 2)
+        + segment
+        + jpeg[2:]
+    )
+
 
 @pytest.fixture
 def create_test_files(tmp_path):
@@ -47,19 +108,49 @@ def test_find_image_files(create_test_files):
     assert found_files == expected_files
 
 
+def test_find_image_paths(create_test_files):
+    """Test that find_image_paths yields the same files as plain strings."""
+    source_dir = create_test_files
+
+    found_paths = list(find_image_paths([source_dir]))
+
+    assert all(type(path) is str for path in found_paths)
+    assert set(found_paths) == {str(path) for path in find_image_files([source_dir])}
+
+
+def test_find_image_files_requires_a_suffix(tmp_path):
+    """Test that names without a real suffix, like dotfiles, are not matched."""
+    (tmp_path / ".jpg").touch()
+    (tmp_path / "jpg").touch()
+    (tmp_path / "photo.JPEG").touch()
+
+    assert set(find_image_files([tmp_path])) == {tmp_path / "photo.JPEG"}
+
+
+def test_find_image_files_skips_directories_and_symlinked_directories(tmp_path):
+    """Test that directories are never yielded and symlinked ones aren't followed."""
+    source_dir = tmp_path / "source"
+    album = source_dir / "album.jpg"
+    album.mkdir(parents=True)
+    (album / "image.jpg").touch()
+
+    outside_dir = tmp_path / "outside"
+    outside_dir.mkdir()
+    (outside_dir / "other.jpg").touch()
+    (source_dir / "link").symlink_to(outside_dir, target_is_directory=True)
+
+    assert set(find_image_files([source_dir])) == {album / "image.jpg"}
+
+
 def test_get_exif_date(tmp_path):
     """Test that get_exif_date correctly extracts the date from EXIF data."""
     # Create an image with EXIF data
     image_with_exif_path = tmp_path / "image_with_exif.jpg"
-    img = Image.new("RGB", (100, 100), color="red")
-    exif_dict = {"Exif": {piexif.ExifIFD.DateTimeOriginal: b"2023:01:01 12:30:00"}}
-    exif_bytes = piexif.dump(exif_dict)
-    img.save(image_with_exif_path, "jpeg", exif=exif_bytes)
+    image_with_exif_path.write_bytes(base64.b64decode(_EXIF_JPEG_B64))
 
     # Create an image without EXIF data
     image_without_exif_path = tmp_path / "image_without_exif.jpg"
-    img_no_exif = Image.new("RGB", (100, 100), color="blue")
-    img_no_exif.save(image_without_exif_path, "jpeg")
+    image_without_exif_path.write_bytes(base64.b64decode(_NOEXIF_JPEG_B64))
 
     # Test the function
     expected_date = datetime(2023, 1, 1, 12, 30, 0)
@@ -67,6 +158,73 @@ def test_get_exif_date(tmp_path):
     assert get_exif_date(image_without_exif_path) is None
 
 
+def test_get_exif_date_little_endian(tmp_path):
+    """Test that get_exif_date reads EXIF data stored in Intel byte order."""
+    # A minimal little-endian TIFF structure: IFD0 points to an Exif IFD
+    # holding DateTimeOriginal
+    tiff = b"II*\x00" + struct.pack("<L", 8)
+    tiff += struct.pack("<HHHLLL", 1, 0x8769, 4, 1, 26, 0)
+    tiff += struct.pack("<HHHLLL", 1, 0x9003, 2, 20, 44, 0)
+    tiff += b"2022:02:03 04:05:06\x00"
+
+    image_path = tmp_path / "image_little_endian.jpg"
+    image_path.write_bytes(_jpeg_with_exif(tiff))
+
+    assert get_exif_date(image_path) == datetime(2022, 2, 3, 4, 5, 6)
+
+
+def test_get_exif_date_beyond_first_read(tmp_path):
+    """Test that an EXIF segment after a large leading segment is still found."""
+    tiff = b"II*\x00" + struct.pack("<L", 8)
+    tiff += struct.pack("<HHHLLL", 1, 0x9003, 2, 20, 26, 0)
+    tiff += b"2021:05:06 07:08:09\x00"
+
+    # A 65000 byte APP2 segment pushes the EXIF segment past the first 64 KiB
+    jpeg = _jpeg_with_exif(tiff)
+    padding = b"\xff\xe2" + struct.pack(">H", 65000) + bytes(64998)
+    image_path = tmp_path / "image_late_exif.jpg"
+    image_path.write_bytes(jpeg[:2] + padding + jpeg[2:])
+
+    assert organize_photos.utils._read_exif_date(image_path) == "2021:05:06 07:08:09"
+
+
+def test_get_exif_date_malformed_date(tmp_path):
+    """Test that get_exif_date returns None for an out-of-range EXIF date."""
+    tiff = b"II*\x00" + struct.pack("<L", 8)
+    tiff += struct.pack("<HHHLLL", 1, 0x8769, 4, 1, 26, 0)
+    tiff += struct.pack("<HHHLLL", 1, 0x9003, 2, 20, 44, 0)
+    tiff += b"2022:13:03 04:05:06\x00"
+
+    image_path = tmp_path / "image_bad_date.jpg"
+    image_path.write_bytes(_jpeg_with_exif(tiff))
+
+    assert get_exif_date(image_path) is None
+
+
+def test_parse_exif_datetime():
+    """Test that EXIF dates are parsed with the fixed-width fast path."""
+    assert _parse_exif_datetime("2023:01:01 12:30:00") == datetime(2023, 1, 1, 12, 30)
+
+
+@pytest.mark.parametrize(
+    "date_str",
+    [
+        "2023-01-01 12:30:00",
+        "2023:13:01 12:30:00",
+        "    :  :     :  :  ",
+        "2_23:01:01 12:30:00",
+        " 023:01:01 12:30:00",
+        "+023:01:01 12:30:00",
+        "2023:01:01 12:30: 0",
+        "2023:+1:01 12:30:00",
+    ],
+)
+def test_parse_exif_datetime_rejects_malformed_dates(date_str):
+    """Test that malformed EXIF dates are rejected, as strptime would."""
+    with pytest.raises(ValueError):
+        _parse_exif_datetime(date_str)
+
+
 def test_create_date_based_directory(tmp_path):
     """Test that the date-based directory is created correctly."""
     destination = tmp_path / "output"
@@ -79,6 +237,33 @@ def test_create_date_based_directory(tmp_path):
     assert expected_dir.is_dir()
 
 
+def test_create_date_based_directory_ymd(tmp_path):
+    """Test that the YYYY/MM/DD directory layout is created correctly."""
+    destination = tmp_path / "output"
+    test_date = datetime(2023, 10, 6)
+
+    date_dir = create_date_based_directory(destination, test_date, scheme="ymd")
+
+    expected_dir = destination / "2023" / "10" / "06"
+    assert date_dir == expected_dir
+    assert expected_dir.is_dir()
+
+
+def test_create_date_based_directory_uses_cache(tmp_path):
+    """Test that directories already in the cache are not created again."""
+    destination = tmp_path / "output"
+    test_date = datetime(2023, 10, 26)
+    dir_cache = {}
+
+    date_dir = create_date_based_directory(destination, test_date, dir_cache)
+    assert dir_cache == {date_dir: set()}
+
+    # A cached directory is trusted to exist, so removing it proves mkdir is skipped
+    date_dir.rmdir()
+    assert create_date_based_directory(destination, test_date, dir_cache) == date_dir
+    assert not date_dir.exists()
+
+
 def test_move_image_with_date(tmp_path):
     """Test moving an image with a date."""
     source_dir = tmp_path / "source"
@@ -115,6 +300,76 @@ def test_move_image_without_date(tmp_path):
     assert not image_path.exists()
 
 
+def test_move_image_across_filesystems(tmp_path, monkeypatch):
+    """Test that moving falls back to copying when a rename isn't possible."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    destination_dir = tmp_path / "destination"
+    destination_dir.mkdir()
+
+    image_path = source_dir / "test.jpg"
+    image_path.write_bytes(b"image data")
+
+    def replace_across_devices(src, dst):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, "replace", replace_across_devices)
+
+    transfer_file(image_path, destination_dir, None, copy=False)
+
+    expected_path = destination_dir / "missing_date" / "test.jpg"
+    assert expected_path.read_bytes() == b"image data"
+    assert not image_path.exists()
+
+
+def test_move_image_across_filesystems_without_copy_file_range(tmp_path, monkeypatch):
+    """Test that a cross-filesystem move still works if the kernel can't copy."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    destination_dir = tmp_path / "destination"
+    destination_dir.mkdir()
+
+    image_path = source_dir / "test.jpg"
+    image_path.write_bytes(b"image data")
+
+    def fail_across_devices(*args):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, "replace", fail_across_devices)
+    monkeypatch.setattr(os, "copy_file_range", fail_across_devices, raising=False)
+
+    transfer_file(image_path, destination_dir, None, copy=False)
+
+    expected_path = destination_dir / "missing_date" / "test.jpg"
+    assert expected_path.read_bytes() == b"image data"
+    assert not image_path.exists()
+
+
+@pytest.mark.parametrize("copy", [True, False])
+def test_transfer_across_filesystems_when_kernel_copies_nothing(
+    tmp_path, monkeypatch, copy
+):
+    """Test that a copy_file_range returning 0 early doesn't truncate the file."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    destination_dir = tmp_path / "destination"
+    destination_dir.mkdir()
+
+    image_path = source_dir / "test.jpg"
+    image_path.write_bytes(b"image data")
+
+    def replace_across_devices(src, dst):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, "replace", replace_across_devices)
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+
+    new_path = transfer_file(image_path, destination_dir, None, copy=copy)
+
+    assert new_path.read_bytes() == b"image data"
+    assert image_path.exists() == copy
+
+
 def test_get_unique_filename(tmp_path):
     """Test that a unique filename is generated when a conflict exists."""
 
@@ -132,6 +387,66 @@ def test_get_unique_filename(tmp_path):
     assert another_path.name == "test-2.jpg"
 
 
+def test_get_unique_filename_with_existing_names(tmp_path):
+    """Test that conflicts are resolved against the given set of names."""
+
+    # These files don't exist on disk, only in the set of existing names
+    existing_names = {"test.jpg", "test-1.jpg"}
+
+    new_path = get_unique_filename(tmp_path / "test.jpg", existing_names)
+    assert new_path.name == "test-2.jpg"
+    assert "test-2.jpg" in existing_names
+
+    # Files on disk are still taken into account
+    other_file = tmp_path / "other.jpg"
+    other_file.touch()
+    assert get_unique_filename(other_file, existing_names).name == "other-1.jpg"
+
+
+def test_get_unique_filename_many_conflicts(tmp_path, monkeypatch):
+    """Test that many conflicts are resolved with a logarithmic number of checks."""
+    (tmp_path / "test.jpg").touch()
+    for i in range(1, 1001):
+        (tmp_path / f"test-{i}.jpg").touch()
+
+    checked = []
+    original_exists = Path.exists
+
+    def spy_exists(self):
+        checked.append(self)
+        return original_exists(self)
+
+    monkeypatch.setattr(Path, "exists", spy_exists)
+
+    new_path = get_unique_filename(tmp_path / "test.jpg")
+
+    assert new_path.name == "test-1001.jpg"
+    # A linear probe would check all 1001 names
+    assert 0 < len(checked) < 25
+
+
+def test_get_unique_filenames_in(tmp_path):
+    """Test that names for one directory are resolved from a single listing."""
+    (tmp_path / "test.jpg").touch()
+    (tmp_path / "test-1.jpg").touch()
+
+    paths = get_unique_filenames_in(tmp_path, ["test.jpg", "other.jpg", "test.jpg"])
+
+    assert [path.name for path in paths] == ["test-2.jpg", "other.jpg", "test-3.jpg"]
+    assert all(path.parent == tmp_path for path in paths)
+
+
+def test_get_unique_filenames_in_checks_chosen_name_on_disk(tmp_path):
+    """Test that a file missing from the given names is still not overwritten."""
+    (tmp_path / "test.jpg").touch()
+
+    # The set doesn't know about test.jpg, as when the filesystem matches names
+    # case-insensitively
+    paths = get_unique_filenames_in(tmp_path, ["test.jpg"], existing_names=set())
+
+    assert [path.name for path in paths] == ["test-1.jpg"]
+
+
 def test_get_unique_filename_no_conflict(tmp_path):
     """Test that the original filename is returned when no conflict exists."""
 
@@ -142,7 +457,7 @@ def test_get_unique_filename_no_conflict(tmp_path):
 
 
 def test_calculate_hash(tmp_path):
-    """Test that the SHA256 hash is calculated correctly."""
+    """Test that the BLAKE3 hash is calculated correctly."""
 
     # Create a dummy file with known content
     image_path = tmp_path / "test.jpg"
@@ -150,7 +465,7 @@ def test_calculate_hash(tmp_path):
     image_path.write_bytes(file_content)
 
     # Calculate the expected hash
-    expected_hash = hashlib.sha256(file_content).hexdigest()
+    expected_hash = blake3.blake3(file_content).hexdigest()
 
     # Calculate the actual hash
     actual_hash = calculate_hash(image_path)
@@ -158,6 +473,160 @@ def test_calculate_hash(tmp_path):
     assert actual_hash == expected_hash
 
 
+def test_calculate_hash_sha256(tmp_path):
+    """Test that the SHA256 hash is calculated correctly."""
+    image_path = tmp_path / "test.jpg"
+    file_content = b"this is a test"
+    image_path.write_bytes(file_content)
+
+    expected_hash = hashlib.sha256(file_content).hexdigest()
+
+    assert calculate_hash(image_path, "sha256") == expected_hash
+
+
+def test_calculate_hash_large_file(tmp_path):
+    """Test that files larger than the read buffer are hashed correctly."""
+    image_path = tmp_path / "large.jpg"
+    file_content = os.urandom(3 * (1 << 20) + 123)
+    image_path.write_bytes(file_content)
+
+    expected_hash = hashlib.sha256(file_content).hexdigest()
+
+    assert calculate_hash(image_path, "sha256") == expected_hash
+
+
+def test_calculate_hash_tree(tmp_path, monkeypatch):
+    """Test that tree mode hashes the concatenated digests of fixed-size slabs."""
+    monkeypatch.setattr(organize_photos.utils, "_TREE_HASH_THRESHOLD", 1000)
+    monkeypatch.setattr(organize_photos.utils, "_TREE_SLAB_SIZE", 400)
+
+    image_path = tmp_path / "large.jpg"
+    file_content = os.urandom(1001)
+    image_path.write_bytes(file_content)
+
+    slab_digests = b"".join(
+        hashlib.sha256(file_content[offset : offset + 400]).digest()
+        for offset in (0, 400, 800)
+    )
+    expected_hash = hashlib.sha256(slab_digests).hexdigest()
+
+    assert calculate_hash(image_path, "sha256", tree=True) == expected_hash
+    # Files at or below the threshold, and the default mode, use the plain digest
+    assert (
+        calculate_hash(image_path, "sha256") == hashlib.sha256(file_content).hexdigest()
+    )
+    image_path.write_bytes(file_content[:1000])
+    assert (
+        calculate_hash(image_path, "sha256", tree=True)
+        == hashlib.sha256(file_content[:1000]).hexdigest()
+    )
+
+
+def test_calculate_hash_xxh3(tmp_path):
+    """Test that the xxh3 hash is calculated correctly."""
+    xxhash = pytest.importorskip("xxhash")
+
+    image_path = tmp_path / "test.jpg"
+    file_content = b"this is a test"
+    image_path.write_bytes(file_content)
+
+    expected_hash = xxhash.xxh3_128(file_content).hexdigest()
+
+    assert calculate_hash(image_path, "xxh3") == expected_hash
+
+
+def test_calculate_hash_xxh3_large_file(tmp_path):
+    """Test that memory-mapped large files are hashed correctly with xxh3."""
+    xxhash = pytest.importorskip("xxhash")
+
+    image_path = tmp_path / "large.jpg"
+    file_content = os.urandom(2 * (1 << 20) + 5)
+    image_path.write_bytes(file_content)
+
+    expected_hash = xxhash.xxh3_128(file_content).hexdigest()
+
+    assert calculate_hash(image_path, "xxh3") == expected_hash
+
+
+def test_calculate_hashes(tmp_path):
+    """Test that hashing files concurrently matches hashing them one by one."""
+    paths = []
+    for i in range(64):
+        path = tmp_path / f"image{i}.jpg"
+        path.write_bytes(os.urandom(i * 1024))
+        paths.append(path)
+
+    expected_hashes = {path: calculate_hash(path) for path in paths}
+
+    assert calculate_hashes(paths, workers=4) == expected_hashes
+
+
+def test_find_duplicate_candidates(tmp_path):
+    """Test that only files sharing a size and prefix are returned as candidates."""
+    file1 = tmp_path / "a.jpg"
+    file2 = tmp_path / "b.jpg"
+    file3 = tmp_path / "c.jpg"
+    file4 = tmp_path / "d.jpg"
+    file5 = tmp_path / "e.jpg"
+    # Same size, and only differing after the prefix
+    file1.write_bytes(b"x" * 5000 + b"1")
+    file2.write_bytes(b"x" * 5000 + b"2")
+    # Same size as the files above, but with a different prefix
+    file3.write_bytes(b"y" * 5001)
+    file4.write_bytes(b"unique size")
+    file5.write_bytes(b"z" * 5001)
+
+    candidates = find_duplicate_candidates([file1, file2, file3, file4, file5])
+
+    assert candidates == {file1, file2}
+
+
+def test_find_duplicates_only_hashes_candidates(tmp_path, monkeypatch):
+    """Test that only the files that may be duplicates are hashed in full."""
+    paths = []
+    for i in range(998):
+        path = tmp_path / f"unique{i}.jpg"
+        path.write_bytes(b"x" * i)
+        paths.append(path)
+    for name in ["dup1.jpg", "dup2.jpg"]:
+        path = tmp_path / name
+        path.write_bytes(b"duplicate" * 1000)
+        paths.append(path)
+
+    hashed = []
+
+    def spy_calculate_hash(path, *args):
+        hashed.append(path)
+        return calculate_hash(path, *args)
+
+    monkeypatch.setattr(organize_photos.utils, "calculate_hash", spy_calculate_hash)
+
+    duplicates = find_duplicates(paths)
+
+    assert sorted(hashed) == [tmp_path / "dup1.jpg", tmp_path / "dup2.jpg"]
+    assert [sorted(paths) for paths in duplicates.values()] == [
+        [tmp_path / "dup1.jpg", tmp_path / "dup2.jpg"]
+    ]
+
+
+def test_find_duplicates_skips_unreadable_files(tmp_path):
+    """Test that a file that can't be read doesn't hide the other duplicates."""
+    file1 = tmp_path / "a.jpg"
+    file2 = tmp_path / "b.jpg"
+    file1.write_bytes(b"same content")
+    file2.write_bytes(b"same content")
+    missing_file = tmp_path / "gone.jpg"
+
+    errors = {}
+    duplicates = find_duplicates([file1, file2, missing_file], errors=errors)
+
+    assert list(duplicates.values()) == [[file1, file2]]
+    assert list(errors) == [missing_file]
+    assert isinstance(errors[missing_file], FileNotFoundError)
+    # Without an errors mapping the file is still skipped
+    assert find_duplicates([file1, file2, missing_file]) == duplicates
+
+
 def test_write_duplicate_report(tmp_path):
     """Test that the duplicate report is written correctly."""
 
@@ -171,13 +640,15 @@ def test_write_duplicate_report(tmp_path):
     file4 = p / "file4.jpg"
     file5 = p / "another" / "file5.jpg"
 
-    duplicates = defaultdict(list)
     # The "old" paths don't matter here, so we'll just make them the same as the new
-    duplicates["hash1"].extend([(file1, file1), (file2, file2)])
-    duplicates["hash2"].append((file3, file3))  # Not a duplicate
-    duplicates["hash3"].extend([(file4, file4), (file5, file5)])
+    with HashStore() as hashes:
+        hashes.add("hash1", file1, file1)
+        hashes.add("hash1", file2, file2)
+        hashes.add("hash2", file3, file3)  # Not a duplicate
+        hashes.add("hash3", file4, file4)
+        hashes.add("hash3", file5, file5)
 
-    write_duplicate_report(destination_dir, duplicates)
+        write_duplicate_report(destination_dir, hashes)
 
     report_path = destination_dir / "duplicates.csv"
     assert report_path.is_file()
@@ -197,6 +668,23 @@ def test_write_duplicate_report(tmp_path):
         assert rows == expected_rows
 
 
+def test_hash_store_duplicates(tmp_path):
+    """Test that the hash store yields only files sharing a hash, in batches."""
+    old_dir = tmp_path / "old"
+    new_dir = tmp_path / "new"
+
+    with HashStore(batch_size=2) as hashes:
+        for name, file_hash in [("a", "h1"), ("b", "h2"), ("c", "h1"), ("d", "h3")]:
+            hashes.add(file_hash, old_dir / f"{name}.jpg", new_dir / f"{name}.jpg")
+
+        duplicates = list(hashes.duplicates())
+
+    assert duplicates == [
+        ("h1", str(new_dir / "a.jpg"), str(old_dir / "a.jpg")),
+        ("h1", str(new_dir / "c.jpg"), str(old_dir / "c.jpg")),
+    ]
+
+
 def test_copy_image_with_date(tmp_path):
     """Test copying an image with a date."""
 
@@ -235,8 +723,44 @@ def test_copy_image_without_date(tmp_path):
     assert image_path.exists()
 
 
-def test_get_files_to_delete(tmp_path):
+def test_copy_image_preserves_content_and_metadata(tmp_path):
+    """Test that copying keeps the file's content and modification time."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    destination_dir = tmp_path / "destination"
+    destination_dir.mkdir()
+
+    image_path = source_dir / "test.jpg"
+    image_path.write_bytes(b"image data" * 1000)
+    os.utime(image_path, (1_000_000_000, 1_000_000_000))
+
+    new_path = transfer_file(image_path, destination_dir, None, copy=True)
+
+    assert new_path.read_bytes() == image_path.read_bytes()
+    assert new_path.stat().st_mtime == image_path.stat().st_mtime
+
+
+def test_transfer_file_accepts_string_paths(tmp_path):
+    """Test that an image given as a string path is transferred."""
+    image_path = tmp_path / "test.jpg"
+    image_path.write_bytes(b"image data")
+    destination_dir = tmp_path / "destination"
+
+    new_path = transfer_file(str(image_path), destination_dir, None, copy=False)
+
+    assert new_path == destination_dir / "missing_date" / "test.jpg"
+    assert new_path.read_bytes() == b"image data"
+
+
+@pytest.mark.parametrize("use_pyarrow", [True, False])
+def test_get_files_to_delete(tmp_path, monkeypatch, use_pyarrow):
     """Test that get_files_to_delete correctly identifies files to be deleted."""
+    if use_pyarrow:
+        pytest.importorskip("pyarrow")
+    else:
+        # Simulate pyarrow not being installed
+        monkeypatch.setitem(sys.modules, "pyarrow", None)
+
     report_path = tmp_path / "duplicates.csv"
     file1 = tmp_path / "a.jpg"
     file2 = tmp_path / "b.jpg"
@@ -256,3 +780,18 @@ def test_get_files_to_delete(tmp_path):
     # Expecting file2 to be deleted, as it's the second in the sorted list for hash1
     assert len(files_to_delete) == 1
     assert file2 in files_to_delete
+
+
+def test_get_files_to_delete_keeps_lowest_path(tmp_path):
+    """Test that only the lowest path of a group survives, whatever its position."""
+    report_path = tmp_path / "duplicates.csv"
+    files = [tmp_path / name for name in ("c.jpg", "a.jpg", "b.jpg")]
+
+    with open(report_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["hash", "new_filepath", "old_filepath"])
+        writer.writerows(["hash1", str(file), "old"] for file in files)
+
+    files_to_delete = get_files_to_delete(report_path)
+
+    assert sorted(files_to_delete) == [tmp_path / "b.jpg", tmp_path / "c.jpg"]